@@ -1,7 +1,210 @@
 from __future__ import print_function
 
+import csv
+import json
+import os
+
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+from numba import njit
+from pyarrow import csv as pacsv
+from pyarrow import dataset as ds
+from pyarrow import parquet as pq
+
+# Dates in the csv files look like "Mon, 2012-03-12 08:30:00"; pyarrow parses
+# them (day of the week included) while the files are read.
+DATE_FORMAT = "%a, %Y-%m-%d %H:%M:%S"
+
+# The columns we use from each csv file and the types to read them as. The
+# source codes repeat heavily, so they are dictionary encoded (category in pandas).
+CONS_COLUMNS = {"cons_id": pa.int64(), "source": pa.dictionary(pa.int32(), pa.string()),
+                "create_dt": pa.timestamp("ns"), "modified_dt": pa.timestamp("ns")
+                }
+CONS_EMAIL_COLUMNS = {"cons_email_id": pa.int64(), "cons_id": pa.int64(), "email": pa.string(),
+                      "create_dt": pa.timestamp("ns"), "modified_dt": pa.timestamp("ns")
+                      }
+CHAPTER_COLUMNS = {"cons_email_id": pa.int64(), "isunsub": pa.int8(),
+                   "unsub_dt": pa.timestamp("ns"), "modified_dt": pa.timestamp("ns")
+                   }
+
+# The number of bytes of a csv file read at a time when caching it as parquet.
+CSV_BLOCK_SIZE = 64 << 20
+
+# How the csv files are parsed when cached as parquet: the ConvertOptions settings
+# and the type of the columns whose type is not given. Both are stored in the cache
+# metadata, so changing any of them rebuilds the caches.
+CSV_CONVERT_OPTIONS = {"timestamp_parsers": [DATE_FORMAT], "strings_can_be_null": True}
+CSV_DEFAULT_TYPE = pa.string()
+
+# datetime64[ns] values viewed as int64: NaT and the number of nanoseconds in a day.
+NAT = np.iinfo(np.int64).min
+NS_PER_DAY = 86_400_000_000_000
+
+
+def cache_metadata(path, column_types):
+    """
+    Describe the csv file, the column types and the parse settings a parquet cache of it is built from.
+
+    Args:
+        path (str): The path of the csv file.
+        column_types (dict): Maps the name of a column to its pyarrow type.
+    Returns:
+        dict: The parquet schema metadata identifying the cache.
+    """
+    stat = os.stat(path)
+    return {b"source_size": str(stat.st_size).encode(),
+            b"source_mtime_ns": str(stat.st_mtime_ns).encode(),
+            b"cache_types": json.dumps({name: str(column_type)
+                                        for name, column_type in column_types.items()},
+                                       sort_keys=True).encode(),
+            b"parse_options": json.dumps(dict(CSV_CONVERT_OPTIONS,
+                                              default_type=str(CSV_DEFAULT_TYPE)),
+                                         sort_keys=True).encode()
+            }
+
+
+def cache_as_parquet(path, column_types):
+    """
+    Convert a csv file to a parquet file next to it, unless an up to date one exists.
+
+    A cache is up to date when the size and modification time of the csv file, the
+    column types and the parse settings (CSV_CONVERT_OPTIONS and CSV_DEFAULT_TYPE) it
+    was built with, all stored in its schema metadata (see cache_metadata), match exactly.
+
+    The csv file is streamed in blocks of CSV_BLOCK_SIZE bytes, each written to the
+    parquet file as it is read, so the whole file is never held in memory. The
+    columns in column_types are read as the given types, with the dates parsed using
+    DATE_FORMAT, and the other columns are read as CSV_DEFAULT_TYPE (inferring their types
+    from the first block alone could fail on a later block). Later runs read the
+    compressed, columnar parquet file instead of parsing the csv file again.
+
+    Args:
+        path (str): The path of the csv file.
+        column_types (dict): Maps the name of a column to its pyarrow type.
+    Returns:
+        str: The path of the parquet file.
+    """
+    parquet_path = os.path.splitext(path)[0] + ".parquet"
+    metadata = cache_metadata(path, column_types)
+    if os.path.exists(parquet_path):
+        cached_metadata = pq.read_schema(parquet_path).metadata or {}
+        if all(cached_metadata.get(key) == value for key, value in metadata.items()):
+            return parquet_path
+    # pyarrow reads the csv as UTF-8 and drops a leading BOM, so read the header the same way.
+    with open(path, newline="", encoding="utf-8-sig") as csv_file:
+        column_names = next(csv.reader(csv_file))
+    convert_options = pacsv.ConvertOptions(column_types={name: column_types.get(name, CSV_DEFAULT_TYPE)
+                                                         for name in column_names},
+                                           **CSV_CONVERT_OPTIONS
+                                           )
+    reader = pacsv.open_csv(path, read_options=pacsv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+                            convert_options=convert_options
+                            )
+    # Write to a temporary file and only move it into place once every block has been
+    # converted, so a failure part way through never leaves a truncated cache behind.
+    temp_path = parquet_path + ".tmp"
+    try:
+        with pq.ParquetWriter(temp_path, reader.schema.with_metadata(metadata),
+                              compression="zstd"
+                              ) as writer:
+            for batch in reader:
+                writer.write_batch(batch)
+        os.replace(temp_path, parquet_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return parquet_path
+
+
+def read_csv(path, column_types, row_filter=None, filter_types=None):
+    """
+    Read the given columns and rows of a csv file into a dataframe with pyarrow.
+
+    The csv file is read through its parquet cache (see cache_as_parquet). Only the
+    columns in column_types are decoded and row_filter is applied while the file is
+    scanned, row group by row group, so rows we do not need are never materialized.
+
+    Args:
+        path (str): The path of the csv file.
+        column_types (dict): Maps the name of each column to read to its pyarrow type.
+        row_filter (Expression): The rows to keep, e.g. ds.field("is_primary") == 1.
+            By default all rows are kept.
+        filter_types (dict): Maps the name of each column used by row_filter but not
+            read to its pyarrow type.
+    Returns:
+        Dataframe
+    """
+    cache_types = dict(column_types, **(filter_types or {}))
+    dataset = ds.dataset(cache_as_parquet(path, cache_types), format="parquet")
+    table = dataset.to_table(columns=list(column_types), filter=row_filter)
+    # Convert without consolidating the columns into 2D blocks, releasing each Arrow
+    # column once converted, so the table and the dataframe are never both held in full.
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def write_csv(df, path):
+    """
+    Write a dataframe to a csv file with pyarrow.
+
+    The dates are written to the second. pyarrow quotes the header and every string
+    field, and writes missing values as empty, unquoted fields.
+
+    Args:
+        df (Dataframe): The dataframe to write.
+        path (str): The path of the csv file.
+    Returns:
+        None
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    columns = [column.cast(pa.timestamp("s")) if pa.types.is_timestamp(column.type) else column
+               for column in table.columns]
+    pacsv.write_csv(pa.table(columns, names=table.column_names), path)
+
+
+@njit(cache=True)
+def civil_from_days(days):
+    """
+    Convert a number of days since 1970-01-01 to a (year, month, day) date.
+
+    This is Howard Hinnant's days_from_civil inverse, valid for the proleptic
+    Gregorian calendar.
+
+    Args:
+        days (int): The number of days since 1970-01-01 (negative before then).
+    Returns:
+        tuple: The year, the month (1-12) and the day of the month (1-31).
+    """
+    z = days + 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    day = doy - (153 * mp + 2) // 5 + 1
+    month = mp + 3 if mp < 10 else mp - 9
+    year = yoe + era * 400 + (1 if month <= 2 else 0)
+    return year, month, day
+
+
+@njit(cache=True)
+def month_day_counts(timestamps):
+    """
+    Count the timestamps falling on each calendar day of the year.
+
+    Args:
+        timestamps (ndarray): datetime64[ns] values viewed as int64. NaT values are skipped.
+    Returns:
+        ndarray: The counts indexed by the integer MMDD (e.g. 1225 for December 25).
+    """
+    counts = np.zeros(1232, np.int64)
+    for timestamp in timestamps:
+        if timestamp == NAT:
+            continue
+        _, month, day = civil_from_days(timestamp // NS_PER_DAY)
+        counts[month * 100 + day] += 1
+    return counts
 
 
 def get_column_info(df):
@@ -14,17 +217,16 @@ def get_column_info(df):
         None
     """
     for col in df.columns:
-        print("column :{}, dtype:{}, size:{}, unique values:{}, missing values: {}"
-              .format(col, df[col].dtype, df[col].size, df[col].unique().size,
-                      df[df[col].isna()].index.size
-                      )
+        column = df[col]
+        print(f"column :{col}, dtype:{column.dtype}, size:{column.size}, "
+              f"unique values:{column.nunique(dropna=False)}, missing values: {column.isna().sum()}"
               )
 
 
 class People:
     """This class produces the people table.
 
-    The class is initialized with 3 dataframes consisting of general information
+    The class reads 3 dataframes consisting of general information
     about the constituents (const), email information about the constituents (primary_emails),
     and subscription information about the constituents (const_sub).
 
@@ -36,67 +238,53 @@ class People:
 
     def __init__(self):
         """
-        Create the initial dataframes from the csv files.
+        Initialize the dataframes, which are read from the csv files by the get methods.
 
         Returns:
              None
         """
-        self.const = pd.read_csv(r"cons.csv")
-        self.primary_emails = pd.read_csv(r"cons_email.csv")
-        self.const_sub = pd.read_csv(r"chapter.csv")
+        self.const = None
+        self.primary_emails = None
+        self.const_sub = None
         self.people = None
         self.acquisition_facts = None
 
     def get_const(self):
         """
-        Get only the relevant columns from the const table and convert to datetime64[ns].
+        Read the relevant columns of the const table with the dates as datetime64[ns].
 
         Returns:
             None
         """
-        self.const = self.const[["cons_id", "source", "create_dt", "modified_dt"]].copy()
-        date_cols = ["create_dt", "modified_dt"]
-        # Strip the day of the week and convert to datetime64[ns]
-        for col in date_cols:
-            self.const[col] = pd.to_datetime(self.const[col].apply(lambda x: x[5:]))
+        self.const = read_csv(r"cons.csv", CONS_COLUMNS)
 
     def get_primary_emails(self):
         """
-        Get only the relevant columns and rows from the primary_emails table and convert to datetime64[ns].
+        Read the relevant columns and rows of the primary_emails table with the dates as datetime64[ns].
 
         Returns:
             None
         """
-        self.primary_emails = self.primary_emails[["cons_email_id", "cons_id", "is_primary",
-                                                   "email", "create_dt", "modified_dt"
-                                                   ]
-                                                  ].copy()
-        self.primary_emails = self.primary_emails[self.primary_emails["is_primary"] == 1].copy()
-        date_cols = ["create_dt", "modified_dt"]
-        # Strip the day of the week and convert to datetime64[ns]
-        for col in date_cols:
-            self.primary_emails[col] = \
-                pd.to_datetime(self.primary_emails[col].apply(lambda x: x[5:]))
+        self.primary_emails = read_csv(r"cons_email.csv", CONS_EMAIL_COLUMNS,
+                                       row_filter=ds.field("is_primary") == 1,
+                                       filter_types={"is_primary": pa.int64()}
+                                       )
 
     def get_const_sub(self):
         """
-        Get only the relevant columns and rows from the const_sub table and convert to datetime64[ns].
+        Read the relevant columns and rows of the const_sub table with the dates as datetime64[ns].
 
         Returns:
             None
         """
-        self.const_sub = self.const_sub[["cons_email_id", "chapter_id", "isunsub",
-                                         "unsub_dt", "modified_dt"]
-                                        ].copy()
-        self.const_sub = self.const_sub[self.const_sub["chapter_id"] == 1].copy()
-        date_cols = ["unsub_dt", "modified_dt"]
-        for col in date_cols:
-            self.const_sub[col] = \
-                pd.to_datetime(self.const_sub[col].apply(lambda x: x[5:]))
+        self.const_sub = read_csv(r"chapter.csv", CHAPTER_COLUMNS,
+                                  row_filter=ds.field("chapter_id") == 1,
+                                  filter_types={"chapter_id": pa.int64()}
+                                  )
 
     def get_people(self):
         """
-        Merge the dataframes using the cons_id and cons_email_id in the tables.
+        Join the dataframes using the cons_id and cons_email_id in the tables.
 
         The people table has the following fields: email (the primary email address),
         code (the source code of the constituent), is_unsub (whether the constituent is
@@ -105,37 +293,34 @@ class People:
 
         Since some of the create_dts are chronologically after the modified_dts in the
         const table, we take the min as the created_dt and the max as the updated_dt.
-        We save the resulting table as people.csv.
+        We save the resulting table as people.csv and people.parquet.
         Returns:
             None
         """
-        self.people = self.primary_emails.merge(self.const_sub, "left",
-                                                on="cons_email_id",
-                                                suffixes=("_pr", "_csub"),
-                                                indicator=True
-                                                ).copy()
-        # Fill the missing values of chapter_id with 1 and unsubscribed with 0
-        # using assumption that if a constituent does not appear in const_sub
-        # then they are still subscribed to chapter 1.
-        self.people = self.people.fillna(value={"chapter_id": 1, "isunsub": 0})
-        self.people = self.const.merge(self.people, "right",
-                                       on="cons_id",
-                                       suffixes=("_con", "_pr"),
-                                       indicator="_merge2"
-                                       ).copy()
+        # Index const_sub and const on their join keys and join both onto the primary
+        # emails, bringing along only the columns the people table needs.
+        people = self.primary_emails[["cons_email_id", "cons_id", "email"]] \
+            .join(self.const_sub.set_index("cons_email_id")["isunsub"], on="cons_email_id") \
+            .join(self.const.set_index("cons_id"), on="cons_id")
         # For some of the records, the created date comes after the modified date in the
         # const table. I took this to mean that there is an error, so I took the minimum
         # of the two dates for the created_dt and the larger for the updated_dt.
-        self.people["created_dt"] = self.people[["create_dt_con", "modified_dt"]].apply(np.min, axis=1)
-        self.people["updated_dt"] = self.people[["create_dt_con", "modified_dt"]].apply(np.max, axis=1)
-        self.people = self.people[["email", "source", "isunsub", "created_dt", "updated_dt"]].copy()
-        self.people.rename(mapper={"email": "email", "source": "code",
-                                   "isunsub": "is_unsub", "created_dt": "created_dt",
-                                   "updated_dt": "updated_dt"}, axis=1, inplace=True
-                           )
-        self.people.to_csv(r"people.csv", index=False,
-                               header=["email", "code", "is_unsub", "created_dt", "updated_dt"],
-                               na_rep='NULL')
+        # np.fmin and np.fmax skip a missing date in favour of the other, as np.min did row by row.
+        create_dts = people["create_dt"].to_numpy()
+        modified_dts = people["modified_dt"].to_numpy()
+        # Fill the missing values of unsubscribed with 0 using assumption that if a
+        # constituent does not appear in const_sub then they are still subscribed to chapter 1.
+        self.people = pd.DataFrame({"email": people["email"],
+                                    "code": people["source"],
+                                    "is_unsub": people["isunsub"].fillna(0).astype("int8"),
+                                    "created_dt": np.fmin(create_dts, modified_dts),
+                                    "updated_dt": np.fmax(create_dts, modified_dts)
+                                    })
+        write_csv(self.people, r"people.csv")
+        # Also save a parquet copy for consumers that only need some of the columns.
+        pq.write_table(pa.Table.from_pandas(self.people, preserve_index=False),
+                       r"people.parquet", compression="zstd"
+                       )
 
     def get_acquisition_facts(self):
         """
@@ -148,43 +333,34 @@ class People:
         Returns:
             None
         """
-        extended_people = self.people.copy()
-        # Get the month and day of the date of creation
-        acq_dates = extended_people["created_dt"].apply(lambda d: d.strftime("%m-%d"))
-        extended_people["acquisition_date"] = acq_dates
-        acquisition_series = extended_people.groupby("acquisition_date")["created_dt"].count()
-        self.acquisition_facts = pd.DataFrame(acquisition_series)
-        self.acquisition_facts.reset_index(inplace=True)
-        self.acquisition_facts.rename(mapper={"acquisition_date": "acquisition_date",
-                                              "created_dt": "acquisitions"}, axis=1, inplace=True
-                                      )
-        self.acquisition_facts.to_csv(r"acquisition_facts.csv", index=False,
-                                          header=["acquisition_date", "acquisitions"]
-                                          )
+        # Count the creation dates per month and day, indexed by the integer MMDD, in a
+        # single compiled pass over the int64 view of the dates. Only the keys that
+        # occur are formatted as strings.
+        created_dts = self.people["created_dt"].to_numpy().view(np.int64)
+        acquisition_counts = month_day_counts(created_dts)
+        keys = np.flatnonzero(acquisition_counts)
+        self.acquisition_facts = pd.DataFrame({
+            "acquisition_date": ["{:02d}-{:02d}".format(key // 100, key % 100) for key in keys],
+            "acquisitions": acquisition_counts[keys]
+        })
+        write_csv(self.acquisition_facts, r"acquisition_facts.csv")
 
 
 if __name__ == "__main__":
     exercise = People()
-    print("Constituents: \n {}".format(exercise.const.head()))
-    get_column_info(exercise.const)
     exercise.get_const()
-    # Verify type conversion performed as expected
+    # Verify the dates were parsed as expected
     get_column_info(exercise.const)
     print("Constituents: \n {}".format(exercise.const.head()))
-    print("Primary_emails: \n {}".format(exercise.primary_emails.head()))
-    get_column_info(exercise.primary_emails)
     exercise.get_primary_emails()
-    # Verify type conversion performed as expected
+    # Verify the dates were parsed as expected
     get_column_info(exercise.primary_emails)
     print("Primary emails: \n {}".format(exercise.primary_emails.head()))
-    print("Constituents Subscription Info: \n {}".format(exercise.const_sub.head()))
-    get_column_info(exercise.const_sub)
     exercise.get_const_sub()
-    # Verify type conversion performed as expected
+    # Verify the dates were parsed as expected
     get_column_info(exercise.const_sub)
     print("Constituents Subscription Info: \n {}".format(exercise.const_sub.head()))
     exercise.get_people()
     print("People: \n {}".format(exercise.people.head()))
     exercise.get_acquisition_facts()
     print("Acquisition facts: \n {}".format(exercise.acquisition_facts.head()))
-